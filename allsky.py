@@ -1,78 +1,144 @@
 import serial
+import os
 import time
 import logging
 from datetime import datetime
 import struct
+import binascii
 import numpy as np
 from astropy.io import fits
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # Test Commands
-COM_TEST = 'E'
+COM_TEST = b'E'
 
 # Shutter Commands
-OPEN_SHUTTER = 'O'
-CLOSE_SHUTTER = 'C'
-DE_ENERGIZE = 'K'
+OPEN_SHUTTER = b'O'
+CLOSE_SHUTTER = b'C'
+DE_ENERGIZE = b'K'
 
 # Heater Commands
-HEATER_ON = 'g\x01'
-HEATER_OFF = 'g\x00'
+HEATER_ON = b'g\x01'
+HEATER_OFF = b'g\x00'
 
 # Setup Commands
-GET_FVERSION = 'V'
-GET_SERIAL = 'r'
-BAUD_RATE = {9600: 'B0',
-             19200: 'B1',
-             38400: 'B2',
-             57600: 'B3',
-             115200: 'B4',
-             230400: 'B5',
-             460800: 'B6'}
+GET_FVERSION = b'V'
+GET_SERIAL = b'r'
+BAUD_RATE = {9600: b'B0',
+             19200: b'B1',
+             38400: b'B2',
+             57600: b'B3',
+             115200: b'B4',
+             230400: b'B5',
+             460800: b'B6'}
 
 # Imaging Commands
-TAKE_IMAGE = 'T'
-ABORT_IMAGE = 'A'
-XFER_IMAGE = 'X'
+TAKE_IMAGE = b'T'
+ABORT_IMAGE = b'A'
+XFER_IMAGE = b'X'
 
-CSUM_OK = 'K'
-CSUM_ERROR = 'R'
-STOP_XFER = 'S'
+CSUM_OK = b'K'
+CSUM_ERROR = b'R'
+STOP_XFER = b'S'
 
-EXPOSURE_IN_PROGRESS = 'E'
-READOUT_IN_PROGRESS = 'R'
-EXPOSURE_DONE = 'D'
+EXPOSURE_IN_PROGRESS = b'E'
+READOUT_IN_PROGRESS = b'R'
+EXPOSURE_DONE = b'D'
 MAX_EXPOSURE = 0x63FFFF
 
 # Guiding Commands
-CALIBRATE_GUIDER = 'H'
-AUTO_GUIDE = 'I'
-TERMINATOR = chr(0x1A)
+CALIBRATE_GUIDER = b'H'
+AUTO_GUIDE = b'I'
+TERMINATOR = b'\x1a'
 
 # Other Constants
 PIXEL_SIZE = 2
+IMAGE_WIDTH = 640
+IMAGE_HEIGHT = 480
+BLOCK_PIXELS = 4096
+BAUD_CACHE = os.path.expanduser('~/.pyallsky_baud')
+PROBE_TIMEOUT = 0.1
+
+# Complemented value of every byte with the most significant bit cleared
+_CSUM_TRANS = bytes(bytearray(~b & 0x7F for b in range(256)))
+
+# Checksum of every possible single byte command
+_CSUM_TABLE = dict((bytes(bytearray((b,))), _CSUM_TRANS[b:b + 1])
+                   for b in range(256))
 
 
 def checksum(command):
     """
-    Return the command with the checksum byte added
-    command - Command string to be sent
+    Return the checksum byte for a command
+    command - Command bytes to be sent
 
     The checksum is simply calculated by complementing the byte, clearing the
     most significant bit and XOR with the current checksum, going through each byte
     in the command. For each individual command the checksum starts as 0
     """
-    cs = 0
-    for b in command:
-        csb = ~ord(b) & 0x7F
-        cs = cs ^ csb
-    return chr(cs)
+    if len(command) == 1:
+        return _CSUM_TABLE[command]
+    arr = np.frombuffer(command.translate(_CSUM_TRANS), dtype=np.uint8)
+    return bytes(bytearray((int(np.bitwise_xor.reduce(arr)),)))
+
+
+# Fixed commands with their checksum byte already appended
+_PACKET_CACHE = dict((c, c + checksum(c)) for c in (
+    COM_TEST, OPEN_SHUTTER, CLOSE_SHUTTER, DE_ENERGIZE, HEATER_ON, HEATER_OFF,
+    GET_FVERSION, GET_SERIAL, ABORT_IMAGE, XFER_IMAGE, CALIBRATE_GUIDER,
+    AUTO_GUIDE))
+
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def _xor_reduce_u8(buf):
+        """
+        XOR together every byte of a uint8 array
+        """
+        s = np.uint8(0)
+        for i in range(buf.shape[0]):
+            s ^= buf[i]
+        return s
+else:
+    def _xor_reduce_u8(buf):
+        """
+        XOR together every byte of a uint8 array
+        """
+        return np.bitwise_xor.reduce(buf)
+
+
+def read_cached_baudrate():
+    """
+    Return the baud rate the camera was last detected at, or None
+    """
+    try:
+        with open(BAUD_CACHE) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def write_cached_baudrate(rate):
+    """
+    Remember the baud rate the camera was detected at for the next connection
+    """
+    try:
+        with open(BAUD_CACHE, 'w') as f:
+            f.write('{}'.format(rate))
+    except IOError:
+        logging.debug('Could not write {}'.format(BAUD_CACHE))
 
 
 def hexify(s, join_char=':'):
     """
     Print a string as hex values
     """
-    return join_char.join(c.encode('hex') for c in s)
+    h = binascii.hexlify(s).decode('ascii')
+    return join_char.join(h[i:i + 2] for i in range(0, len(h), 2))
 
 
 class AllSkyCamera():
@@ -83,25 +149,39 @@ class AllSkyCamera():
     def __init__(self, device):
         ser = serial.Serial(device)
 
-        # Camera baud rate is initially unknown, so find it
+        # Camera baud rate is initially unknown, so find it, starting with the
+        # rate it was last found at
+        rates = sorted(BAUD_RATE, key=BAUD_RATE.get)[:-2]
+        cached = read_cached_baudrate()
+        if cached in rates:
+            rates.remove(cached)
+            rates.insert(0, cached)
+
         found = False
-        for rate in sorted(BAUD_RATE, key=BAUD_RATE.get)[:-2]:
+        timeout = ser.timeout
+        ser.timeout = PROBE_TIMEOUT
+        for rate in rates:
             logging.debug('Testing : {}'.format(rate))
             ser.baudrate = rate
-            ser.write(COM_TEST + checksum(COM_TEST))
-            time.sleep(0.1)
+            ser.flushInput()
+            ser.write(_PACKET_CACHE[COM_TEST])
             # Expect a 2 byte response for this command
-            if ser.inWaiting():
-                data = ser.read(ser.inWaiting())
-                if data == ':0':
-                    found = True
-                    logging.debug('Baud rate on camera set to {}'.format(rate))
-                    break
+            if ser.read(2) == b':0':
+                found = True
+                logging.debug('Baud rate on camera set to {}'.format(rate))
+                if rate != cached:
+                    write_cached_baudrate(rate)
+                break
+        ser.timeout = timeout
 
         if not found:
             logging.debug('Detection failed')
         self._ser = ser
 
+        # Scratch buffer for blocks read without an out buffer, allocated on
+        # first use
+        self._block_buf = None
+
     def set_baudrate(self, baud):
         """
         Set the camera baud rate. Does not work yet.
@@ -119,21 +199,24 @@ class AllSkyCamera():
         rs = self._ser.read(1)
         self._ser.baudrate = baud
         assert(rs == cs)
-        assert(self._ser.read(1) == 'S')
+        assert(self._ser.read(1) == b'S')
 
-        com = 'Test'
+        com = b'Test'
         self._ser.write(com + cs)
         time.sleep(0.1)
 
-        assert(self._ser.read(6) == 'TestOk')
-        self._ser.write('k')
+        assert(self._ser.read(6) == b'TestOk')
+        self._ser.write(b'k')
 
         time.sleep(1)
-        print self._ser.inWaiting()
+        print(self._ser.inWaiting())
 
     def _send_command(self, command):
-        cs = checksum(command)
-        self._ser.write(command + cs)
+        packet = _PACKET_CACHE.get(command)
+        if packet is None:
+            packet = command + checksum(command)
+        cs = packet[-1:]
+        self._ser.write(packet)
         response = self._ser.read(1)
         if response != cs:
             logging.error('Command error reponse to {}'.format(command))
@@ -192,13 +275,7 @@ class AllSkyCamera():
         returns the string of calibration data sent back from camera
         """
         self._send_command(CALIBRATE_GUIDER)
-        response = ''
-        a = ''
-        while a != TERMINATOR:
-            a = self._ser.read(1)
-            response += a
-
-        return response
+        return self._ser.read_until(TERMINATOR)
 
     def autonomous_guide(self):
         """
@@ -206,31 +283,50 @@ class AllSkyCamera():
         returns -- Data sent back from camera
         """
         self._send_command(AUTO_GUIDE)
-        response = ''
-        a = ''
-        while a != TERMINATOR:
-            a = self._ser.read(1)
-            response += a
+        return self._ser.read_until(TERMINATOR)
 
-        return response
-
-    def _get_image_block(self, expected=4096, ignore_cs=False):
+    def _read_into(self, view):
+        """
+        Fill a writable buffer from the serial port
+        view -- memoryview to read into
+        raises SerialException if the port times out before the buffer is full
+        """
+        offset = 0
+        while offset < len(view):
+            n = self._ser.readinto(view[offset:])
+            if not n:
+                raise serial.SerialException(
+                    'Timed out after {} of {} bytes'.format(offset, len(view)))
+            offset += n
+
+    def _get_image_block(self, expected=BLOCK_PIXELS, ignore_cs=False, out=None):
         """
         Get one 'block' of image data. At full frame the camera returns image
         data in chunks of 4096 pixels. For different imaging modes this value
         will change, but the caller can simply change the value of expected.
         expected -- Number of pixels to retrieve
         ignore_cs -- always pass checksum without checking (for debug only)
+        out -- writable uint8 array of expected * PIXEL_SIZE + 1 bytes to read
+               into, the last byte receives the checksum
+        returns the block data, which is overwritten by the next call when out
+        is not given
         """
+        if out is None:
+            size = expected * PIXEL_SIZE + 1
+            if self._block_buf is None or len(self._block_buf) != size:
+                self._block_buf = np.empty(size, dtype=np.uint8)
+            out = self._block_buf
+        view = memoryview(out)
+        data = out[:-1]
+
         valid = False
         cs_failed = 0
         while not valid:
-            data = self._ser.read(expected * PIXEL_SIZE)
-            cs_byte = ord(self._ser.read(1))
+            # Block and trailing checksum byte in a single read
+            self._read_into(view)
+            cs_byte = int(out[-1])
 
-            cs = 0
-            for c in data:
-                cs = cs ^ ord(c)
+            cs = int(_xor_reduce_u8(data))
 
             if cs == cs_byte:
                 self._ser.write(CSUM_OK)
@@ -243,7 +339,8 @@ class AllSkyCamera():
 
             if cs_failed > 0:
                 logging.error('Checksum failed')
-        logging.debug('Processed {} bytes'.format(len(data)))
+        # Lazy formatting, this runs for every block
+        logging.debug('Processed %d bytes', len(data))
         return data
 
     def get_image(self, exposure=1.0, progress_callback=None):
@@ -253,36 +350,42 @@ class AllSkyCamera():
         progress_callback -- Function to be called after each block downloaded
         returns an astropy HDUList object
         """
+        if exposure < 0:
+            raise ValueError('Exposure time must not be negative')
         # Camera expsosure time works in 100us units
         exptime = exposure / 100e-6
         if exptime > MAX_EXPOSURE:
             exptime = MAX_EXPOSURE
             exposure = 653.3599
-        exp = struct.pack('I', exptime)[:3]
-        com = TAKE_IMAGE + exp[::-1] + chr(0x00) + chr(0x01)
+        exptime = int(exptime)
+        # 24 bit big endian exposure time followed by the two option bytes
+        com = struct.pack('>cBBBBB', TAKE_IMAGE, (exptime >> 16) & 0xFF,
+                          (exptime >> 8) & 0xFF, exptime & 0xFF, 0x00, 0x01)
 
         timestamp = datetime.now().isoformat()
 
         logging.debug('Beginning Exposure')
         self._send_command(com)
-        # Wait for exposure to finish
-        while True:
-            d = self._ser.read(1)
-            if d == EXPOSURE_DONE:
-                logging.debug('Exposure Complete')
-                break
+        # Wait for exposure to finish, skipping the progress bytes
+        self._ser.read_until(EXPOSURE_DONE)
+        logging.debug('Exposure Complete')
 
         # Download Image
-        blocks_expected = (640 * 480) / 4096
+        blocks_expected = (IMAGE_WIDTH * IMAGE_HEIGHT) // BLOCK_PIXELS
         self._send_command(XFER_IMAGE)
 
-        data = ''
-        blocks_complete = 0
-        for _ in range(blocks_expected):
-            data += self._get_image_block()
-            blocks_complete += 1
+        # Blocks are read straight into the image. The spare byte at the end
+        # takes the checksum of the last block, every other checksum byte is
+        # overwritten by the block that follows it.
+        block_size = BLOCK_PIXELS * PIXEL_SIZE
+        frame = np.empty(blocks_expected * block_size + 1, dtype=np.uint8)
+        get_block = self._get_image_block
+        percent_per_block = 100.0 / blocks_expected
+        for i in range(blocks_expected):
+            offset = i * block_size
+            get_block(out=frame[offset:offset + block_size + 1])
             if progress_callback is not None:
-                progress_callback(float(blocks_complete) / blocks_expected * 100)
+                progress_callback((i + 1) * percent_per_block)
 
         logging.debug('Image download complete')
 
@@ -292,9 +395,9 @@ class AllSkyCamera():
         head['EXPOSURE'] = '{}'.format(exposure)
         head['DATE-OBS'] = timestamp
 
-        # Now make into a fits image
-        data = np.fromstring(data, dtype=np.uint16)
-        data = data.reshape((480, 640))
+        # Now make into a fits image, reinterpreting the downloaded bytes in
+        # place as pixels
+        data = frame[:-1].view(np.uint16).reshape((IMAGE_HEIGHT, IMAGE_WIDTH))
         hdu = fits.PrimaryHDU(data, header=head)
 
         return hdu
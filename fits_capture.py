@@ -1,6 +1,9 @@
 from allsky import AllSkyCamera
 import serial
-import argparse, sys
+import argparse, sys, io, os
+
+# Uncompressed FITS extensions, anything else is left to astropy
+FITS_EXTENSIONS = ('.fits', '.fit', '.fts')
 
 
 def capture_image(device, exposure_time, savefile):
@@ -9,7 +12,20 @@ def capture_image(device, exposure_time, savefile):
         cam.open_shutter()
         print('Downloading image ...')
         image = cam.get_image(exposure=exposure_time)
-        image.writeto(savefile)
+        savefile = os.path.expanduser(savefile)
+        if savefile.lower().endswith(FITS_EXTENSIONS):
+            # Build the file in memory so it reaches the disk in one write
+            # rather than the many small writes astropy makes, which is slow
+            # on network filesystems. Like writeto, refuse to overwrite an
+            # existing file.
+            buf = io.BytesIO()
+            image.writeto(buf)
+            fd = os.open(savefile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf.getvalue())
+        else:
+            # Possibly compressed, let astropy pick the format from the name
+            image.writeto(savefile)
     except serial.serialutil.SerialException as err:
         print(str(err))
         sys.exit(2)